@@ -1,8 +1,34 @@
+# Patch the stdlib before anything else imports socket/ssl, so requests/urllib3
+# yield to the gevent loop while waiting on the backend API.
+from gevent import monkey
+monkey.patch_all()
+
 import os
 import logging
+from xml.sax.saxutils import escape
+import gevent
+import redis
+from redis.backoff import NoBackoff
+from redis.retry import Retry as RedisRetry
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import Flask, request, jsonify, make_response
-from twilio.twiml.messaging_response import MessagingResponse
+
+# orjson is a CPython C extension; fall back to the stdlib so the bot also runs under PyPy,
+# where the JIT makes the pure-Python json module fast enough.
+try:
+    import orjson
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+    JSONDecodeError = orjson.JSONDecodeError
+except ImportError:
+    import json
+    json_dumps = json.dumps
+    json_loads = json.loads
+    # json.loads(bytes) raises UnicodeDecodeError on invalid UTF-8, not JSONDecodeError;
+    # both are ValueErrors (as is orjson.JSONDecodeError), so catch that instead.
+    JSONDecodeError = ValueError
 
 # Enable logging
 logging.basicConfig(
@@ -18,15 +44,73 @@ API_ENDPOINT = os.getenv("API_ENDPOINT")  # e.g. "https://your-api.herokuapp.com
 if not API_ENDPOINT:
     raise ValueError("API_ENDPOINT environment variable not set.")
 
-# In-memory session store: { "<user_number>": {"session_id": ..., "first_name": ..., ...} }
+# Shared HTTP session so the connection to the backend API is pooled and kept alive
+# across webhook calls instead of paying a new TCP+TLS handshake per message.
+SESSION = requests.Session()
+SESSION.headers.update({'Content-Type': 'application/json'})
+# urllib3 never re-sends a POST once it may have reached the backend, so the only thing
+# retried here is failing to connect (refused/timed-out connections), never 5xx replies.
+_adapter = HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(total=2, backoff_factor=0.1)
+)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
+def build_twiml(message):
+    # TwiML for a single text reply is a tiny fixed envelope, so emit it directly
+    # rather than building an element tree through the Twilio SDK.
+    return f'<?xml version="1.0" encoding="UTF-8"?><Response><Message>{escape(message or "")}</Message></Response>'
+
+# Per-socket connect/read timeouts for the backend call. These don't bound the whole call:
+# connect retries stack up and the read timeout restarts on every chunk received.
+API_TIMEOUT = (2, 6)
+# Hard wall-clock limit on the whole backend call (retries and slow bodies included), leaving
+# room inside Twilio's 10 second webhook window to send the fallback reply.
+API_DEADLINE = 8  # seconds
+
+# Pre-serialised TwiML for canned replies, so the timeout/error paths do no XML work
+TIMEOUT_TWIML = build_twiml("Sorry, the server is taking too long to respond. Please try again in a moment.")
+ERROR_TWIML = build_twiml("Sorry, I'm having trouble connecting to the server. Please try again later.")
+
+# Session store: { "<user_number>": {"session_id": ..., "first_name": ..., ...} }
+# With REDIS_URL set, sessions live in Redis so any gunicorn worker can serve any user.
+# Without it we fall back to a per-process dict, which is only correct with a single worker.
+REDIS_URL = os.getenv("REDIS_URL")
+SESSION_STORE_TTL = 3600  # seconds
+# Short socket timeouts and no client-side retries, so each session read/write costs at most
+# about 0.5 s to connect plus 0.5 s per read even when Redis is down. redis-py otherwise retries
+# every command with exponential backoff, which could push the reply past Twilio's 10 s window.
+redis_client = redis.Redis.from_url(
+    REDIS_URL, decode_responses=True, socket_timeout=0.5, socket_connect_timeout=0.5,
+    retry=RedisRetry(NoBackoff(), 0)
+) if REDIS_URL else None
 session_store = {}
 
 def get_session_data(user_number):
+    if redis_client is not None:
+        # If Redis is unavailable, carry on with an empty session rather than failing the reply
+        try:
+            return json_loads(redis_client.get(f"sess:{user_number}") or "{}")
+        except redis.RedisError as e:
+            logger.error(f"Session read failed for {user_number}: {e}")
+            return {}
     if user_number not in session_store:
         session_store[user_number] = {}
     return session_store[user_number]
 
+def save_session_data(user_number, session_data):
+    if redis_client is not None:
+        try:
+            redis_client.setex(f"sess:{user_number}", SESSION_STORE_TTL, json_dumps(session_data))
+        except redis.RedisError as e:
+            logger.error(f"Session write failed for {user_number}: {e}")
+    else:
+        session_store[user_number] = session_data
+
 @app.route("/whatsapp", methods=['POST'])
+@app.route("/whatsapp/webhook", methods=['POST'])
 def whatsapp_webhook():
     # Twilio sends multiple fields, the most important are 'From' and 'Body'
     # 'From' is the sender's number in WhatsApp format: "whatsapp:+123456789"
@@ -63,19 +147,14 @@ def whatsapp_webhook():
     # We'll attempt a product detail request only if:
     # 1. The user last received product suggestions.
     # 2. The user's message matches one of the mentioned products from the last message.
-    mentioned_products = session_data.get('last_mentioned_products', [])
+    # The session keeps a lowercase title -> title index of the last mentioned products.
+    mentioned_index = session_data.get('mentioned_index', {})
 
     # Check if user wants product detail
     request_type = 'message'
-    product_title_requested = None
-    if mentioned_products:
-        # Normalize input and check against known products
-        user_lower = user_message.lower()
-        for p in mentioned_products:
-            if p['title'].lower() == user_lower:
-                product_title_requested = p['title']
-                request_type = 'product_detail'
-                break
+    product_title_requested = mentioned_index.get(user_message.lower())
+    if product_title_requested:
+        request_type = 'product_detail'
 
     if request_type == 'product_detail':
         payload['type'] = 'product_detail'
@@ -91,37 +170,62 @@ def whatsapp_webhook():
             }
 
     # Send request to the backend API
+    # gevent.Timeout is a BaseException, so requests/urllib3 can't catch and re-wrap it mid-read
+    deadline = gevent.Timeout(API_DEADLINE)
+    deadline.start()
     try:
-        resp = requests.post(API_ENDPOINT, json=payload)
+        # The session already sends Content-Type: application/json
+        resp = SESSION.post(API_ENDPOINT, data=json_dumps(payload), timeout=API_TIMEOUT)
         resp.raise_for_status()
-        data = resp.json()
-    except requests.RequestException as e:
+        data = json_loads(resp.content)
+    except gevent.Timeout as t:
+        if t is not deadline:
+            raise
+        logger.error(f"API request exceeded the {API_DEADLINE}s deadline")
+        return twiml_response(TIMEOUT_TWIML)
+    except requests.Timeout as e:
+        logger.error(f"API request timed out: {e}")
+        return twiml_response(TIMEOUT_TWIML)
+    except (requests.RequestException, JSONDecodeError) as e:
         logger.error(f"API request failed: {e}")
-        return respond("Sorry, I'm having trouble connecting to the server. Please try again later.")
+        return twiml_response(ERROR_TWIML)
+    finally:
+        deadline.close()
 
     # Handle the API response
-    gpt_response = data.get('reply', '')
-    mentioned_products = data.get('mentioned_products', [])
+    # The backend may send "reply": null, e.g. for product-only answers
+    gpt_response = data.get('reply') or ''
+    mentioned_products = data.get('mentioned_products') or []
 
-    # Store mentioned products in session for future detail requests
-    session_data['last_mentioned_products'] = mentioned_products
+    # Index mentioned products by lowercase title for future detail requests
+    session_data['mentioned_index'] = {p['title'].lower(): p['title'] for p in mentioned_products}
+    # Superseded by mentioned_index; drop it from sessions stored before the switch
+    session_data.pop('last_mentioned_products', None)
+    save_session_data(user_id, session_data)
 
     # Construct reply
     # If products are mentioned, guide the user to type the product title to see more details.
-    if mentioned_products:
-        product_list_text = "\n".join([f"- {p['title']}" for p in mentioned_products])
-        gpt_response += f"\n\nWe have these products mentioned above. To get more details on any product, just reply with the product name:\n{product_list_text}"
+    return respond(_append_products(gpt_response, mentioned_products))
+
 
-    return respond(gpt_response)
+def _append_products(reply, products):
+    # Append the list of mentioned product titles the user can reply with
+    if not products:
+        return reply
+    product_list_text = "\n".join([f"- {p['title']}" for p in products])
+    return reply + f"\n\nWe have these products mentioned above. To get more details on any product, just reply with the product name:\n{product_list_text}"
 
 
 def respond(message):
     # Twilio expects a TwiML response
-    resp = MessagingResponse()
-    resp.message(message)
-    return make_response(str(resp), 200)
+    return twiml_response(build_twiml(message))
+
+
+def twiml_response(twiml):
+    return make_response(twiml, 200, {"Content-Type": "application/xml"})
 
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port)
+    from gevent.pywsgi import WSGIServer
+    WSGIServer(("0.0.0.0", port), app).serve_forever()